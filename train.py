@@ -12,8 +12,12 @@ $ torchrun --standalone --nproc_per_node=4 train.py
 import os
 import sys
 import time
-import math
+import threading
+import functools
+import itertools
+import importlib.util
 from ast import literal_eval
+from contextlib import nullcontext
 
 import wandb
 import numpy as np
@@ -28,7 +32,7 @@ from model import GPTConfig, GPT
 # I/O
 out_dir = 'out'
 eval_interval = 500
-log_interval = 1
+log_interval = 10 # losses are averaged on the gpu and only synced to the host every log_interval iters
 eval_iters = 50
 eval_only = False # if True, script exits right after the first eval
 # wandb logging
@@ -40,6 +44,8 @@ wandb_run_name = 'gpt2' # 'run' + str(time.time())
 dataset = 'openwebtext'
 batch_size = 8
 block_size = 1024
+grad_accum_steps = 1 # micro-batches of batch_size to accumulate gradients over per optimizer step
+max_preload_gb = 4 # RAM budget per node for reading .bin files fully into memory instead of memmapping them
 # model
 device = 'cuda:0'
 init_from = 'scratch' # 'scratch' or 'resume' or 'gpt2*'
@@ -52,6 +58,7 @@ learning_rate = 2.5e-4 # max learning rate
 max_iters = 500000 # total number of training iterations
 weight_decay = 1e-2
 betas = (0.9, 0.95)
+grad_clip = 1.0 # clip gradients at this global norm, or disable if == 0.0
 # learning rate decay settings
 decay_lr = True # whether to decay the learning rate
 warmup_iters = 2000 # how many steps to warm up for
@@ -59,7 +66,11 @@ lr_decay_iters = 320000 # how many steps to decay the learning rate for
 min_lr = 1e-5 # minimum learning rate
 # DDP settings
 backend = 'nccl' # 'nccl', 'gloo', etc.
+bucket_cap_mb = 50 # size of the gradient buckets DDP allreduces while backward is still running
 compile_model = True # use PyTorch 2.0 to compile the model to be faster
+# torch.compile mode: 'max-autotune-no-cudagraphs' autotunes the triton kernels, 'default' skips that.
+# not 'max-autotune' or 'reduce-overhead': both capture cuda graphs, which this training loop does not support
+compile_mode = 'max-autotune-no-cudagraphs'
 # -----------------------------------------------------------------------------
 # poor man's Configurator. Potentially a bad idea. Example usage:
 # $ python train.py override_file --batch_size=32
@@ -72,7 +83,11 @@ for arg in sys.argv[1:]:
         print(f"Overriding config with {config_file}:")
         with open(config_file) as f:
             print(f.read())
-        exec(open(config_file).read())
+        # import it as a module rather than exec its source: bytecode gets cached and errors get real tracebacks
+        spec = importlib.util.spec_from_file_location("config", config_file)
+        config_module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(config_module)
+        globals().update({k: v for k, v in vars(config_module).items() if not k.startswith('_')})
     else:
         # assume it's a --key=value argument
         assert arg.startswith('--')
@@ -100,24 +115,78 @@ if ddp:
     device = f"cuda:{gpu_id}"
 else:
     gpu_id = 0 # gpu_id 0 means this is the (single) master process, basically
+torch.cuda.set_device(device) # so the current device (and its streams/events) matches the tensors we use
 
 if gpu_id == 0:
     os.makedirs(out_dir, exist_ok=True)
 torch.manual_seed(1337 + gpu_id) # note: each worker gets a different seed
-torch.backends.cuda.matmul.allow_tf32 = True # allow tf32 on matmul
+torch.set_float32_matmul_precision('high') # allow tf32 on matmul, the form torch.compile understands
 torch.backends.cudnn.allow_tf32 = True # allow tf32 on cudnn
+torch.backends.cudnn.benchmark = True # shapes are fixed, so let cudnn pick the fastest kernels
+torch.autograd.set_detect_anomaly(False) # make sure the (very slow) autograd anomaly checks are off
+autocast_ctx = torch.amp.autocast(device_type="cuda", dtype=torch.bfloat16) # built once, re-entered every forward
 
 # poor man's data loader, TODO evaluate need for actual DataLoader
 data_dir = os.path.join('data', dataset)
-train_data = np.memmap(os.path.join(data_dir, 'train.bin'), dtype=np.uint16, mode='r')
-val_data = np.memmap(os.path.join(data_dir, 'val.bin'), dtype=np.uint16, mode='r')
-def get_batch(split):
-    data = train_data if split == 'train' else val_data
-    ix = torch.randint(len(data) - block_size, (batch_size,))
-    x = torch.stack([torch.from_numpy((data[i:i+block_size]).astype(np.int64)) for i in ix])
-    y = torch.stack([torch.from_numpy((data[i+1:i+1+block_size]).astype(np.int64)) for i in ix])
-    x, y = x.to(device), y.to(device)
+def load_data(path):
+    # random reads from a memmap pay for page faults and readahead, so if it fits just keep it all in RAM.
+    # every process on the node gets its own private copy though, unlike the shared page cache of a memmap
+    local_world_size = int(os.environ.get('LOCAL_WORLD_SIZE', 1))
+    if os.path.getsize(path) * local_world_size < max_preload_gb * 1024**3:
+        return np.fromfile(path, dtype=np.uint16)
+    return np.memmap(path, dtype=np.uint16, mode='r')
+train_data = load_data(os.path.join(data_dir, 'train.bin'))
+val_data = load_data(os.path.join(data_dir, 'val.bin'))
+# batches are staged in pinned host memory so that the copy to the gpu can be async
+# staged as int32 (torch has no uint16) and only widened to int64 on the gpu, halving the bytes over pcie
+# two sets are used ping-pong, so filling the next batch never waits on the copy of the one just issued
+def make_pinned_buffers():
+    x_pinned = torch.empty((batch_size, block_size), dtype=torch.int32, pin_memory=True)
+    y_pinned = torch.empty((batch_size, block_size), dtype=torch.int32, pin_memory=True)
+    pinned_free = torch.cuda.Event() # recorded after each copy, so we never overwrite a buffer still in flight
+    return x_pinned, y_pinned, pinned_free
+pinned_buffers = itertools.cycle([make_pinned_buffers(), make_pinned_buffers()])
+offsets = np.arange(block_size + 1, dtype=np.int64) # a row of x plus its one-token-shifted target
+# batch sampling gets its own per-rank generator, independent of the global RNG used for model init / dropout
+batch_generator = torch.Generator(device='cpu')
+batch_generator.manual_seed(1337 + gpu_id)
+def get_batch(data):
+    ix = torch.randint(len(data) - block_size, (batch_size,), generator=batch_generator).numpy()
+    window = data[ix[:, None] + offsets[None, :]] # a single (batch_size, block_size+1) gather
+    x_pinned, y_pinned, pinned_free = next(pinned_buffers)
+    pinned_free.synchronize()
+    np.copyto(x_pinned.numpy(), window[:, :-1])
+    np.copyto(y_pinned.numpy(), window[:, 1:])
+    x = x_pinned.to(device, non_blocking=True)
+    y = y_pinned.to(device, non_blocking=True)
+    pinned_free.record(torch.cuda.current_stream(device)) # the stream that carries the copies
+    x, y = x.long(), y.long()
     return x, y
+# bound once per split, so the hot path no longer branches on the split name to pick its data
+get_train_batch = functools.partial(get_batch, train_data)
+get_val_batch = functools.partial(get_batch, val_data)
+
+class Prefetcher:
+    """ double-buffers training batches: loads batch N+1 on a side stream while batch N computes """
+
+    def __init__(self, get_batch_fn):
+        self.get_batch_fn = get_batch_fn
+        self.stream = torch.cuda.Stream(device=device)
+        self.preload()
+
+    def preload(self):
+        # call this once the current step's work is queued, so the cpu-side gather doesn't delay its launch
+        with torch.cuda.stream(self.stream):
+            self.X, self.Y = self.get_batch_fn()
+
+    def next(self):
+        # make the compute stream wait for the copy, and tell the allocator it now uses these tensors
+        stream = torch.cuda.current_stream(device)
+        stream.wait_stream(self.stream)
+        X, Y = self.X, self.Y
+        X.record_stream(stream)
+        Y.record_stream(stream)
+        return X, Y
 
 # init these up here, can override if init_from='resume' (i.e. from a checkpoint)
 iter_num = 0
@@ -157,44 +226,78 @@ optimizer = model.configure_optimizers(weight_decay, learning_rate, betas)
 if init_from == 'resume':
     optimizer.load_state_dict(checkpoint['optimizer'])
 
+# make sure the attention the compiled graph captures is one of the fused sdpa kernels, not the math fallback
+assert hasattr(torch.nn.functional, 'scaled_dot_product_attention'), "fused attention requires PyTorch >= 2.0"
+torch.backends.cuda.enable_flash_sdp(True)
+torch.backends.cuda.enable_mem_efficient_sdp(True)
+torch.backends.cuda.enable_math_sdp(False)
+
 # compile the model
 if compile_model:
     print("compiling the model... (takes a ~minute)")
     unoptimized_model = model
-    model = torch.compile(model) # requires PyTorch 2.0
+    # batch_size and block_size never change, so compile for static shapes and never recompile for new ones
+    model = torch.compile(model, mode=compile_mode, dynamic=False) # requires PyTorch 2.0
 
 # wrap model into DDP container
 if ddp:
-    model = DDP(model, device_ids=[gpu_id])
+    # grads become views into the allreduce buckets (no extra copy, as long as they are zeroed in place rather
+    # than set to None each step, see zero_grad below), and the graph never changes between iters
+    model = DDP(model, device_ids=[gpu_id], bucket_cap_mb=bucket_cap_mb,
+                gradient_as_bucket_view=True, static_graph=True)
 
 @torch.no_grad()
 def estimate_loss():
     out = {}
     model.eval()
-    for split in ['train', 'val']:
-        losses = torch.zeros(eval_iters)
+    for split, get_split_batch in [('train', get_train_batch), ('val', get_val_batch)]:
+        losses = torch.zeros(eval_iters, device=device) # accumulated on the gpu, so no sync per eval iter
         for k in range(eval_iters):
-            X, Y = get_batch(split)
-            with torch.amp.autocast(device_type="cuda", dtype=torch.bfloat16):
+            X, Y = get_split_batch()
+            with autocast_ctx:
                 logits, loss = model(X, Y)
-            losses[k] = loss.item()
-        out[split] = losses.mean()
+            losses[k] = loss.detach()
+        out[split] = losses.mean().item() # the one CPU-GPU sync per split
     model.train()
     return out
 
-# learning rate decay scheduler (cosine with warmup)
-def get_lr(iter):
+# learning rate decay scheduler (cosine with warmup), precomputed for every iter so the loop just indexes it
+def get_lr_schedule(num_iters):
+    it = np.arange(num_iters, dtype=np.float64)
     # 1) linear warmup for warmup_iters steps
-    if iter < warmup_iters:
-        return learning_rate * iter / warmup_iters
-    # 2) if iter > lr_decay_iters, return min learning rate
-    if iter > lr_decay_iters:
-        return min_lr
-    # 3) in between, use cosine decay down to min learning rate
-    decay_ratio = (iter - warmup_iters) / (lr_decay_iters - warmup_iters)
-    assert 0 <= decay_ratio <= 1
-    coeff = 0.5 * (1.0 + math.cos(math.pi * decay_ratio)) # coeff ranges 0..1
-    return min_lr + coeff * (learning_rate - min_lr)
+    warmup = learning_rate * it / max(warmup_iters, 1)
+    # 2) in between, use cosine decay down to min learning rate
+    decay_ratio = np.clip((it - warmup_iters) / (lr_decay_iters - warmup_iters), 0, 1)
+    coeff = 0.5 * (1.0 + np.cos(np.pi * decay_ratio)) # coeff ranges 0..1
+    decay = min_lr + coeff * (learning_rate - min_lr)
+    # 3) if iter > lr_decay_iters, use min learning rate
+    return np.where(it < warmup_iters, warmup, np.where(it > lr_decay_iters, min_lr, decay))
+lr_schedule = get_lr_schedule(max(max_iters, lr_decay_iters) + 1) # past its end the lr is min_lr
+
+def to_cpu(obj):
+    # copy all tensors of a (nested) state_dict to the cpu, so that training can keep mutating the originals.
+    # these are blocking copies into pageable memory on purpose: non_blocking ones would need pinned memory the
+    # size of the model + optimizer state, which the caching host allocator would then hold on to for good
+    if isinstance(obj, torch.Tensor):
+        return obj.detach().to('cpu', copy=True)
+    if isinstance(obj, dict):
+        return {k: to_cpu(v) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(to_cpu(v) for v in obj)
+    return obj
+
+def save_checkpoint(checkpoint, path):
+    # write to a temporary file first and only then swap it in, so an interrupted write never clobbers path
+    tmp_path = path + '.tmp'
+    torch.save(checkpoint, tmp_path, pickle_protocol=5)
+    os.replace(tmp_path, path)
+
+def save_checkpoint_async(checkpoint, path):
+    # snapshot on the cpu synchronously, then do the (slow, multi-GB) disk write on a background thread
+    checkpoint = to_cpu(checkpoint)
+    thread = threading.Thread(target=save_checkpoint, args=(checkpoint, path))
+    thread.start()
+    return thread
 
 # logging
 if wandb_log and gpu_id == 0:
@@ -206,13 +309,18 @@ if wandb_log and gpu_id == 0:
     }
 
 # training loop
+param_groups = optimizer.param_groups # bound after any load_state_dict, which replaces the list
+prefetcher = Prefetcher(get_train_batch)
+loss_buf = torch.zeros(log_interval, device=device) # recent losses, kept on the gpu to avoid a sync per iter
+loss_count = 0 # how many entries of loss_buf were filled since the last log
+save_thread = None # background thread writing the latest checkpoint, if any
 t0 = time.time()
 while True:
 
     # determine the learning rate for this iteration
     if decay_lr:
-        lr = get_lr(iter_num)
-        for param_group in optimizer.param_groups:
+        lr = float(lr_schedule[min(iter_num, len(lr_schedule) - 1)]) # e.g. resuming past a lowered max_iters
+        for param_group in param_groups:
             param_group['lr'] = lr
     else:
         lr = learning_rate
@@ -238,29 +346,48 @@ while True:
                     'iter_num': iter_num,
                     'best_val_loss': best_val_loss,
                 }
-                torch.save(checkpoint, os.path.join(out_dir, 'ckpt.pt'))
+                if save_thread is not None:
+                    save_thread.join() # never have two writes to the same ckpt.pt in flight
+                save_thread = save_checkpoint_async(checkpoint, os.path.join(out_dir, 'ckpt.pt'))
     if iter_num == 0 and eval_only:
         break
 
-    X, Y = get_batch('train')
-    with torch.amp.autocast(device_type="cuda", dtype=torch.bfloat16):
-        logits, loss = model(X, Y)
-
-    optimizer.zero_grad(set_to_none=True)
-    loss.backward()
-    # TODO: gradient clipping evaluate need for
+    # under DDP the grads are views into the allreduce buckets, so zero them in place to keep them that way
+    optimizer.zero_grad(set_to_none=not ddp)
+    for micro_step in range(grad_accum_steps):
+        X, Y = prefetcher.next()
+        # with DDP, only allreduce the gradients on the last micro step, before that just accumulate locally
+        sync_ctx = model.no_sync() if ddp and micro_step < grad_accum_steps - 1 else nullcontext()
+        with sync_ctx:
+            with autocast_ctx:
+                logits, loss = model(X, Y)
+                loss = loss / grad_accum_steps # grads accumulate by summing, so this makes them a mean
+            # backward deliberately stays outside autocast: each backward op already runs in the dtype
+            # its forward op was autocast to, so the saved activations are bf16 either way
+            loss.backward()
+        prefetcher.preload() # forward/backward are queued, gather the next micro-batch while they run
+    if grad_clip != 0.0:
+        # foreach computes the global norm and rescales all grads in a couple of kernels, not a loop over params
+        torch.nn.utils.clip_grad_norm_(model.parameters(), max_norm=grad_clip, foreach=True)
     optimizer.step()
 
-    t1 = time.time()
-    dt = t1 - t0
-    t0 = t1
-    if iter_num % log_interval == 0 and gpu_id == 0:
-        lossf = loss.item() # loss as float. TODO CPU-GPU sync: profile, make sure not slow af
-        print(f"iter {iter_num}: loss {lossf:.4f}, time {dt*1000:.2f}ms")
+    loss_buf[loss_count] = loss.detach() * grad_accum_steps # undo the scaling for reporting
+    loss_count += 1
+    if loss_count == log_interval:
+        # only log once the buffer is full of losses from this process, e.g. also right after a resume
+        loss_count = 0
+        if gpu_id == 0:
+            lossf = loss_buf.mean().item() # the one CPU-GPU sync per log_interval iters
+            t1 = time.time()
+            dt = (t1 - t0) / log_interval # averaged, since without a sync per iter single timings are meaningless
+            t0 = t1
+            print(f"iter {iter_num}: loss {lossf:.4f}, time {dt*1000:.2f}ms")
     iter_num += 1
 
     # termination conditions
     if iter_num >= max_iters:
         break
 
+if save_thread is not None:
+    save_thread.join()
 destroy_process_group()